@@ -10,15 +10,16 @@
 
 import io
 import math
-import tempfile
 from datetime import datetime
-from typing import Dict, List, Tuple
+from typing import TYPE_CHECKING, Dict, List, Tuple
 
 import numpy as np
 import pandas as pd
 import streamlit as st
-from fpdf import FPDF
-import matplotlib.pyplot as plt
+
+# fpdf is only needed once a PDF is built; it is imported inside the PDF builders
+if TYPE_CHECKING:
+    from fpdf import FPDF
 
 # ────────────────────────────────────────────────────────────────
 # App config
@@ -107,8 +108,13 @@ def clean_int(x, default=0) -> int:
     except Exception:
         return int(default)
 
-def explode_cuts(length_mm: int, qty: int) -> List[int]:
-    return [length_mm] * max(qty, 0)
+_FILENAME_TRANS = str.maketrans({" ": "_", "/": "-"})  # one translate pass for download / ZIP entry names
+
+def explode_cuts(g: pd.DataFrame) -> List[int]:
+    """
+    One entry per piece for a cleaned group (see group_required_table).
+    """
+    return np.repeat(g["Cut Length (mm)"].to_numpy(np.int64), g["Quantity"].to_numpy(np.int64)).tolist()
 
 def first_fit_decreasing(cuts_mm: List[int], stock_len_mm: int, kerf_mm: float) -> List[Dict]:
     """
@@ -139,70 +145,57 @@ def first_fit_decreasing(cuts_mm: List[int], stock_len_mm: int, kerf_mm: float)
 
     return bars
 
-def plot_bars_png(bars: List[Dict], stock_len_mm: int) -> bytes:
+def draw_bars_pdf(pdf: "FPDF", bars: List[Dict], stock_len_mm: int, kerf_mm: float):
     """
-    Create a stacked-strip figure (one row per bar) and return PNG bytes.
+    Draw the cut layout onto the PDF page: one strip per bar, one filled rectangle per cut.
     """
-    if len(bars) == 0:
-        fig, ax = plt.subplots(figsize=(8, 1.5))
-        ax.axis("off")
-        buf = io.BytesIO()
-        fig.savefig(buf, format="png", bbox_inches="tight", dpi=200)
-        plt.close(fig)
-        return buf.getvalue()
-
-    rows = len(bars)
-    height = max(2.0, 0.35 * rows + 1.0)  # scale height by number of bars
-
-    fig, ax = plt.subplots(figsize=(9, height))
-    ax.set_xlim(0, stock_len_mm)
-    ax.set_ylim(0, rows)
-    ax.set_xlabel("mm")
-    ax.set_ylabel("Stock Bars")
-
-    # Draw each bar as a line + rectangles for cuts
-    for i, bar in enumerate(bars):
-        y = rows - i - 0.5
-        ax.hlines(y, 0, stock_len_mm, linewidth=1)
-        x = 0.0
-        for j, cut in enumerate(bar["cuts"]):
-            # rectangle [x, x+cut]
-            rect = plt.Rectangle((x, y - 0.15), cut, 0.3, fill=True, alpha=0.5)
-            ax.add_patch(rect)
-            ax.text(x + cut / 2, y, f"{int(cut)}", ha="center", va="center", fontsize=7)
-            x += cut
-            if j < len(bar["cuts"]) - 1:
-                # kerf gap
-                x += kerf_mm
+    label_w = 26  # right-hand column for the waste label
+    x0 = pdf.l_margin
+    width = pdf.w - pdf.l_margin - pdf.r_margin - label_w
+    scale = width / max(stock_len_mm, 1)
+    row_h, gap = 6, 2
+
+    pdf.set_font("Helvetica", "", 7)
+    pdf.set_draw_color(0, 0, 0)
+    pdf.set_fill_color(158, 194, 227)
+    for bar in bars:
+        if pdf.get_y() + row_h > pdf.page_break_trigger:
+            pdf.add_page()
+        y = pdf.get_y()
+        # Stock bar outline
+        pdf.rect(x0, y, width, row_h)
+
+        # Segment starts in one cumsum (cut + kerf gap between cuts); cuts starting past the bar end are not drawn
+        cuts = np.asarray(bar["cuts"], dtype=np.float64)
+        steps = cuts + kerf_mm
+        starts = np.cumsum(steps) - steps
+        visible = starts < stock_len_mm
+        widths = np.minimum(cuts, stock_len_mm - starts) * scale
+        for cut, x, w in zip(cuts[visible].tolist(), starts[visible].tolist(), widths[visible].tolist()):
+            pdf.rect(x0 + x * scale, y, w, row_h, "DF")
+            if w >= 8:
+                pdf.set_xy(x0 + x * scale, y)
+                pdf.cell(w, row_h, f"{int(cut)}", align="C")
 
         # waste label
-        waste = max(stock_len_mm - (x), 0.0)
-        ax.text(
-            stock_len_mm - 5, y + 0.22, f"Waste: {int(round(waste))} mm",
-            ha="right", va="center", fontsize=7
-        )
-
-    ax.grid(True, axis="x", linestyle=":", linewidth=0.6)
-    ax.set_yticks([])
-    buf = io.BytesIO()
-    fig.tight_layout()
-    fig.savefig(buf, format="png", dpi=200)
-    plt.close(fig)
-    return buf.getvalue()
+        waste = max(stock_len_mm - (cuts.sum() + kerf_mm * max(cuts.size - 1, 0)), 0.0)
+        pdf.set_xy(x0 + width, y)
+        pdf.cell(label_w, row_h, f"Waste: {int(round(waste))} mm", align="R")
+        pdf.set_y(y + row_h + gap)
 
 def mm_to_m(millimetres: float) -> float:
     return float(millimetres) / 1000.0
 
 def per_tag_summary(tag_df: pd.DataFrame, total_bars: int, stock_length_mm: int) -> Dict:
     total_cuts = int(tag_df["Quantity"].sum()) if "Quantity" in tag_df.columns else 0
-    total_cut_len_mm = float((tag_df["Cut Length (mm)"] * tag_df["Quantity"]).sum())
+    total_cut_len_mm = float(np.dot(tag_df["Cut Length (mm)"].to_numpy(np.float64), tag_df["Quantity"].to_numpy(np.float64)))
     meters_ordered = total_bars * mm_to_m(stock_length_mm)
-    # Assume one cost per meter per Tag (take first nonzero or first)
+    # Assume one cost per meter per Tag (take first nonzero or first); already cleaned by group_required_table
     cost_per_m = 0.0
     if "Cost per meter (ZAR)" in tag_df.columns and len(tag_df) > 0:
-        # prefer a nonzero; else fallback to first value
-        vals = [clean_float(v, 0.0) for v in tag_df["Cost per meter (ZAR)"].tolist()]
-        cost_per_m = next((v for v in vals if v > 0), (vals[0] if len(vals) else 0.0))
+        costs = tag_df["Cost per meter (ZAR)"]
+        nonzero = costs[costs > 0]
+        cost_per_m = float(nonzero.iloc[0] if len(nonzero) else costs.iloc[0])
     total_cost = meters_ordered * cost_per_m
     return {
         "total_cuts": total_cuts,
@@ -212,7 +205,7 @@ def per_tag_summary(tag_df: pd.DataFrame, total_bars: int, stock_length_mm: int)
         "total_cost": total_cost,
     }
 
-def write_tag_section_to_pdf(pdf: FPDF, tag_name: str, section: str, stock_len_mm: int,
+def write_tag_section_to_pdf(pdf: "FPDF", tag_name: str, section: str, stock_len_mm: int,
                              kerf_mm: float, tag_df: pd.DataFrame, bars: List[Dict],
                              material: str):
     # Header
@@ -222,21 +215,23 @@ def write_tag_section_to_pdf(pdf: FPDF, tag_name: str, section: str, stock_len_m
     pdf.cell(0, 6, f"Material: {material}    Stock Length: {stock_len_mm} mm    Kerf: {kerf_mm} mm", ln=1)
     pdf.ln(1)
 
-    # Table header
+    # Table header; grey borders as under the project header (the previous tag's layout drew in black)
+    pdf.set_draw_color(180, 180, 180)
     pdf.set_font("Helvetica", "B", 10)
     pdf.cell(50, 7, "Cut Length (mm)", border=1)
     pdf.cell(30, 7, "Quantity", border=1)
     pdf.cell(40, 7, "Cost/m (ZAR)", border=1)
     pdf.cell(60, 7, "Note", border=1, ln=1)
 
-    # Table rows
+    # Table rows: each column formatted once (already cleaned by group_required_table), then one loop of cells
     pdf.set_font("Helvetica", "", 10)
-    for _, r in tag_df.iterrows():
-        pdf.cell(50, 7, f"{clean_int(r['Cut Length (mm)'])}", border=1)
-        pdf.cell(30, 7, f"{clean_int(r['Quantity'])}", border=1)
-        pdf.cell(40, 7, f"{clean_float(r.get('Cost per meter (ZAR)', 0.0)):.2f}", border=1)
-        note = str(r.get("Note", "")) if "Note" in tag_df.columns else ""
-        pdf.cell(60, 7, note[:30], border=1, ln=1)
+    notes = tag_df["Note"].astype(str).str[:30] if "Note" in tag_df.columns else [""] * len(tag_df)
+    for length, qty, cost, note in zip(tag_df["Cut Length (mm)"].astype(str), tag_df["Quantity"].astype(str),
+                                       tag_df["Cost per meter (ZAR)"].map("{:.2f}".format), notes):
+        pdf.cell(50, 7, length, border=1)
+        pdf.cell(30, 7, qty, border=1)
+        pdf.cell(40, 7, cost, border=1)
+        pdf.cell(60, 7, note, border=1, ln=1)
 
     pdf.ln(2)
 
@@ -245,26 +240,25 @@ def write_tag_section_to_pdf(pdf: FPDF, tag_name: str, section: str, stock_len_m
     pdf.set_font("Helvetica", "B", 10)
     pdf.cell(0, 6, "Per-Tag Summary:", ln=1)
     pdf.set_font("Helvetica", "", 10)
-    pdf.cell(0, 6, f"• Total cuts: {sums['total_cuts']}", ln=1)
-    pdf.cell(0, 6, f"• Total cut length: {int(round(sums['total_cut_len_mm']))} mm", ln=1)
-    pdf.cell(0, 6, f"• Bars used: {len(bars)}  (each {stock_len_mm} mm)", ln=1)
-    pdf.cell(0, 6, f"• Meters ordered: {sums['meters_ordered']:.3f} m", ln=1)
-    pdf.cell(0, 6, f"• Cost per meter: ZAR {sums['cost_per_m']:.2f}", ln=1)
-    pdf.cell(0, 6, f"• Total cost: ZAR {sums['total_cost']:.2f}", ln=1)
+    # One multi_cell for the whole block; "-" bullets because FPDF core fonts are latin-1 only
+    summary_lines = [
+        f"- Total cuts: {sums['total_cuts']}",
+        f"- Total cut length: {int(round(sums['total_cut_len_mm']))} mm",
+        f"- Bars used: {len(bars)}  (each {stock_len_mm} mm)",
+        f"- Meters ordered: {sums['meters_ordered']:.3f} m",
+        f"- Cost per meter: ZAR {sums['cost_per_m']:.2f}",
+        f"- Total cost: ZAR {sums['total_cost']:.2f}",
+    ]
+    pdf.multi_cell(0, 6, "\n".join(summary_lines), align="L")
 
     # Visual bar chart
-    img_bytes = plot_bars_png(bars, stock_len_mm)
-    with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
-        tmp.write(img_bytes)
-        tmp_path = tmp.name
     pdf.ln(2)
     pdf.set_font("Helvetica", "B", 10)
     pdf.cell(0, 6, "Cut Layout Visualization:", ln=1)
-    # Fit image width
-    pdf.image(tmp_path, w=190)
+    draw_bars_pdf(pdf, bars, stock_len_mm, kerf_mm)
     pdf.ln(4)
 
-def build_project_header(pdf: FPDF, meta: Dict):
+def build_project_header(pdf: "FPDF", meta: Dict):
     pdf.set_font("Helvetica", "B", 16)
     pdf.cell(0, 10, f"{meta.get('Project Name','')}", ln=1)
     pdf.set_font("Helvetica", "", 11)
@@ -282,20 +276,23 @@ def build_project_header(pdf: FPDF, meta: Dict):
     ]
     y0 = pdf.get_y()
     xL, xR = pdf.get_x(), 110
-    pdf.set_xy(xL, y0)
-    for key, label in left:
-        pdf.set_font("Helvetica", "B", 11); pdf.cell(40, 7, f"{label}:", ln=0)
-        pdf.set_font("Helvetica", "", 11); pdf.cell(60, 7, f"{meta.get(key,'')}", ln=1)
-    pdf.set_xy(xR, y0)
-    for key, label in right:
-        pdf.set_font("Helvetica", "B", 11); pdf.cell(40, 7, f"{label}:", ln=0)
-        pdf.set_font("Helvetica", "", 11); pdf.cell(60, 7, f"{meta.get(key,'')}", ln=1)
+    # Column by column, one font switch per column of labels / values; rows are placed explicitly
+    # so the right-hand column stays at xR
+    for x, w, font, texts in (
+        (xL, 40, "B", [f"{label}:" for _, label in left]), (xL + 40, 60, "", [f"{meta.get(key,'')}" for key, _ in left]),
+        (xR, 40, "B", [f"{label}:" for _, label in right]), (xR + 40, 60, "", [f"{meta.get(key,'')}" for key, _ in right]),
+    ):
+        pdf.set_font("Helvetica", font, 11)
+        for i, text in enumerate(texts):
+            pdf.set_xy(x, y0 + 7 * i); pdf.cell(w, 7, text)
+    pdf.set_xy(xL, y0 + 7 * max(len(left), len(right)))
     pdf.ln(2)
     pdf.set_draw_color(180, 180, 180)
     pdf.line(10, pdf.get_y(), 200, pdf.get_y())
     pdf.ln(4)
 
 def consolidated_pdf(meta: Dict, tag_payloads: List[Tuple[str, str, int, float, pd.DataFrame, List[Dict]]]) -> bytes:
+    from fpdf import FPDF
     pdf = FPDF(orientation="P", unit="mm", format="A4")
     pdf.set_auto_page_break(auto=True, margin=10)
     pdf.add_page()
@@ -310,6 +307,7 @@ def consolidated_pdf(meta: Dict, tag_payloads: List[Tuple[str, str, int, float,
 
 def single_tag_pdf(meta: Dict, tag: str, section: str, stock_len_mm: int, kerf_mm: float,
                    tag_df: pd.DataFrame, bars: List[Dict]) -> bytes:
+    from fpdf import FPDF
     pdf = FPDF(orientation="P", unit="mm", format="A4")
     pdf.set_auto_page_break(auto=True, margin=10)
     pdf.add_page()
@@ -343,6 +341,11 @@ def group_required_table(df: pd.DataFrame) -> Dict[Tuple[str, str], pd.DataFrame
 
     # Filter valid rows
     df = df[(df["Tag"] != "") & (df["Cut Length (mm)"] > 0) & (df["Quantity"] > 0)].copy()
+    priced = df[df["Cost per meter (ZAR)"] > 0]
+    cost_counts = priced.groupby("Tag", sort=False)["Cost per meter (ZAR)"].nunique()
+    mixed = cost_counts.index[cost_counts > 1].tolist()
+    if mixed:
+        st.warning(f"Tag(s) {', '.join(mixed)} have more than one Cost per meter; the first non-zero value is used.")
     groups = {}
     for (tag, sect), g in df.groupby(["Tag", "Section"], dropna=False):
         groups[(tag, sect)] = g.reset_index(drop=True)
@@ -416,10 +419,7 @@ def build_payload_by_required_cuts(req_df: pd.DataFrame, stock_len_mm: int, kerf
     payloads = []
     groups = group_required_table(req_df)
     for (tag, sect), g in groups.items():
-        # expand cuts
-        pieces = []
-        for _, r in g.iterrows():
-            pieces.extend(explode_cuts(clean_int(r["Cut Length (mm)"]), clean_int(r["Quantity"])))
+        pieces = explode_cuts(g)
         bars = first_fit_decreasing(pieces, stock_len_mm, kerf_mm)
         payloads.append((tag or "UNTAGGED", sect or "-", stock_len_mm, kerf_mm, g, bars))
     return payloads
@@ -446,63 +446,54 @@ def build_payload_from_stock(req_df: pd.DataFrame, stock_df: pd.DataFrame, kerf_
     stock_df["Stock Length (mm)"] = stock_df["Stock Length (mm)"].apply(clean_int)
     stock_df["Bars Available"] = stock_df["Bars Available"].apply(clean_int)
 
-    stock_by_tag: Dict[str, List[Tuple[int, int]]] = {}
-    for _, r in stock_df.iterrows():
-        if r["Tag"] == "" or r["Stock Length (mm)"] <= 0 or r["Bars Available"] <= 0:
-            continue
-        stock_by_tag.setdefault(r["Tag"], []).append((int(r["Stock Length (mm)"]), int(r["Bars Available"])))
+    ok = (stock_df["Tag"] != "") & (stock_df["Stock Length (mm)"] > 0) & (stock_df["Bars Available"] > 0)
+    stock_by_tag: Dict[str, List[Tuple[int, int]]] = {
+        tag: list(zip(s["Stock Length (mm)"].tolist(), s["Bars Available"].tolist()))
+        for tag, s in stock_df[ok].groupby("Tag", sort=False)
+    }
 
     for (tag, sect), g in req_groups.items():
-        # Create list of required pieces
-        pieces = []
-        for _, r in g.iterrows():
-            pieces.extend(explode_cuts(clean_int(r["Cut Length (mm)"]), clean_int(r["Quantity"])))
-
-        pieces = sorted([p for p in pieces if p > 0], reverse=True)
+        # Required pieces, longest first
+        pieces = sorted(explode_cuts(g), reverse=True)
 
-        # Build stock bars list for this Tag
+        # Stock bars for this Tag as parallel arrays (length, used length, cut count per bar)
         inventory = stock_by_tag.get(tag, [])
-        # Create actual bar bins: list of dicts each with its own length
-        bars: List[Dict] = []
-        for length_mm, qty in inventory:
-            for _ in range(int(qty)):
-                bars.append({"len": length_mm, "cuts": [], "used": 0.0})
-
-        # Place with first-fit decreasing across variable-length bars
-        remaining = pieces.copy()
-        for piece in remaining[:]:
-            placed = False
-            for bar in bars:
-                needed = piece + (kerf_mm if len(bar["cuts"]) > 0 else 0.0)
-                if bar["used"] + needed <= bar["len"] + 1e-6:
-                    bar["cuts"].append(piece)
-                    bar["used"] += needed
-                    placed = True
-                    break
-            if placed:
-                # remove one occurrence from remaining
-                remaining.remove(piece)
+        lens = np.repeat([length_mm for length_mm, _ in inventory], [qty for _, qty in inventory]).astype(np.float64)
+        used = np.zeros(lens.size)
+        n_cuts = np.zeros(lens.size, dtype=np.int64)
+        bar_of = np.full(len(pieces), -1, dtype=np.int64)  # bar index per piece, -1 = not placed
+
+        # Place with first-fit decreasing across variable-length bars: one vectorised fit test per piece
+        for i, piece in enumerate(pieces):
+            needed = piece + np.where(n_cuts > 0, kerf_mm, 0.0)
+            fits = np.flatnonzero(used + needed <= lens + 1e-6)
+            if fits.size:
+                j = fits[0]
+                used[j] += needed[j]; n_cuts[j] += 1; bar_of[i] = j
+        placed = bar_of >= 0
+        by_bar = np.asarray(pieces, dtype=np.int64)[placed][np.argsort(bar_of[placed], kind="stable")]
+        bar_cuts = [c.tolist() for c in np.split(by_bar, np.cumsum(n_cuts)[:-1])] if lens.size else []
+        remaining = [piece for piece, j in zip(pieces, bar_of.tolist()) if j < 0]
 
         # If remaining pieces, estimate additional bars needed using a base length:
         if len(remaining) > 0:
             base_len = inventory[0][0] if len(inventory) > 0 else 6000
             extra_bars = first_fit_decreasing(remaining, base_len, kerf_mm)
-            # convert to consistent structure with "len" for plotting
-            for b in extra_bars:
-                bars.append({"len": base_len, "cuts": b["cuts"][:], "used": b["used"]})
+            bar_cuts += [b["cuts"][:] for b in extra_bars]
+            lens = np.concatenate([lens, np.full(len(extra_bars), float(base_len))])
+            used = np.concatenate([used, [b["used"] for b in extra_bars]])
 
         # Determine dominant length for plotting
-        if len(bars) == 0:
+        if lens.size == 0:
             dominant_len = (inventory[0][0] if len(inventory) else 6000)
         else:
-            lengths = [b["len"] for b in bars]
-            dominant_len = int(pd.Series(lengths).mode().iloc[0])
+            vals, counts = np.unique(lens, return_counts=True)
+            dominant_len = int(vals[counts.argmax()])
 
-        # Normalize bars list for figure axis
-        normalized_bars = []
-        for b in bars:
-            used = b["used"] if b["len"] == dominant_len else b["used"] * (dominant_len / max(b["len"], 1))
-            normalized_bars.append({"cuts": b["cuts"], "used": used, "waste": max(dominant_len - used, 0.0)})
+        # Normalize bars for the figure axis: used length rescaled to the dominant stock length
+        used = used * np.where(lens == dominant_len, 1.0, dominant_len / np.maximum(lens, 1))
+        waste = np.maximum(dominant_len - used, 0.0)
+        normalized_bars = [{"cuts": c, "used": u, "waste": w} for c, u, w in zip(bar_cuts, used.tolist(), waste.tolist())]
 
         payloads.append((tag or "UNTAGGED", sect or "-", dominant_len, kerf_mm, g, normalized_bars))
 
@@ -524,11 +515,12 @@ if run:
         else:
             # Build consolidated PDF
             if mode in ("Nest by Required Cuts", "Nest from Stock"):
+                file_stem = f"nesting_{project_meta['Project Name'].translate(_FILENAME_TRANS)}"
                 all_pdf = consolidated_pdf(project_meta, tag_payloads)
                 st.download_button(
                     "⬇️ Download Consolidated PDF",
                     data=all_pdf,
-                    file_name=f"nesting_{project_meta['Project Name'].replace(' ','_')}.pdf",
+                    file_name=f"{file_stem}.pdf",
                     mime="application/pdf",
                     use_container_width=True,
                 )
@@ -538,13 +530,13 @@ if run:
                     files = {}
                     for tag, sect, slen, k, g, bars in tag_payloads:
                         b = single_tag_pdf(project_meta, tag, sect, slen, k, g, bars)
-                        safe = f"{tag}_{sect}".replace(" ", "_").replace("/", "-")
+                        safe = f"{tag}_{sect}".translate(_FILENAME_TRANS)
                         files[f"{safe}.pdf"] = b
                     z = zip_bytes(files)
                     st.download_button(
                         "⬇️ Download Per-Tag PDFs (ZIP)",
                         data=z,
-                        file_name=f"nesting_{project_meta['Project Name'].replace(' ','_')}_per_tag.zip",
+                        file_name=f"{file_stem}_per_tag.zip",
                         mime="application/zip",
                         use_container_width=True,
                     )
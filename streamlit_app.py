@@ -1,21 +1,17 @@
 # Steel Nesting Planner v14.1 — Metadata table full width + PG Bison layout, logo fixed, no charts (18 Aug 2025)
 # Modes: Nest by Required Cuts · Nest from Stock · View Summary Report
 
-import os, io, math, tempfile, base64
+import os, io, math, bisect, hashlib
 from datetime import datetime
-from typing import Dict, List, Tuple
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
 import streamlit as st
-from fpdf import FPDF
 
-# Pillow improves logo reliability (JPG/PNG → PNG)
-try:
-    from PIL import Image
-    _PIL_OK = True
-except Exception:
-    _PIL_OK = False
+# fpdf, Pillow, zipfile and tempfile are only needed once a PDF is built; they are imported lazily below
+if TYPE_CHECKING:
+    from fpdf import FPDF
 
 st.set_page_config(page_title="Steel Nesting Planner v14.1", layout="wide")
 st.title("🧰 Steel Nesting Planner v14.1 — PG Bison layout (full-width meta), logo fixed, no charts")
@@ -26,6 +22,10 @@ STOCK_DEFAULT_MM = 6000
 # ── Sidebar ─────────────────────────────────────────────────────
 st.sidebar.header("⚙️ Settings")
 kerf_mm = float(st.sidebar.number_input("Kerf (mm)", min_value=0.0, step=0.5, value=KERF_DEFAULT_MM))
+strategy = {"Best-Fit Decreasing": "bfd", "First-Fit Decreasing": "ffd"}[st.sidebar.selectbox(
+    "Nesting Strategy", ["Best-Fit Decreasing", "First-Fit Decreasing"], index=0,
+    help="Best-Fit puts each cut on the fullest bar it still fits, usually needing fewer bars."
+)]
 mode = st.sidebar.radio("Mode", ["Nest by Required Cuts", "Nest from Stock", "View Summary Report"])
 
 stock_choice = st.sidebar.selectbox(
@@ -42,28 +42,29 @@ offer_zip = st.sidebar.checkbox("Also export per-Section PDFs as ZIP", value=Fal
 st.header("📁 Project Details (PG Bison layout)")
 logo_file = st.file_uploader("Company Logo (PNG/JPG)", type=["png", "jpg", "jpeg"])
 
+# Widgets are keyed "meta:<label>", so the values live in st.session_state and are read once where needed
 colA1, colA2 = st.columns(2)
 with colA1:
-    project_name = st.text_input("Project", "PG Bison Extraction Ducts")
-    project_location = st.text_input("Location", "Ugie")
-    drawing_number = st.text_input("Drawing Number", "MDF070-044-000-000")
-    revision_number = st.text_input("Revision", "1.0")
+    st.text_input("Project", "PG Bison Extraction Ducts", key="meta:Project")
+    st.text_input("Location", "Ugie", key="meta:Location")
+    st.text_input("Drawing Number", "MDF070-044-000-000", key="meta:Drawing Number")
+    st.text_input("Revision", "1.0", key="meta:Revision")
 with colA2:
-    material_type = st.text_input("Material", "Mild Steel")
-    cutting_by = st.text_input("Cutting List By", "Wynand Oppermann")
-    date_created = st.text_input("Date Created", datetime.now().strftime("%Y-%m-%d"))
-    notes_header = st.text_input("Document Note (optional)", "")
-
-project_meta = {
-    "Project": project_name,
-    "Location": project_location,
-    "Drawing Number": drawing_number,
-    "Revision": revision_number,
-    "Material": material_type,
-    "Cutting List By": cutting_by,
-    "Date Created": date_created,
-    "Document Note": notes_header.strip(),
-}
+    st.text_input("Material", "Mild Steel", key="meta:Material")
+    st.text_input("Cutting List By", "Wynand Oppermann", key="meta:Cutting List By")
+    st.text_input("Date Created", datetime.now().strftime("%Y-%m-%d"), key="meta:Date Created")
+    st.text_input("Document Note (optional)", "", key="meta:Document Note")
+
+PROJECT_FIELDS = ["Project", "Location", "Drawing Number", "Revision", "Material", "Cutting List By",
+                  "Date Created", "Document Note"]
+
+def read_project_meta() -> Dict[str, str]:
+    """
+    The project details as one dict, straight from session_state.
+    """
+    meta = {label: st.session_state[f"meta:{label}"] for label in PROJECT_FIELDS}
+    meta["Document Note"] = meta["Document Note"].strip()
+    return meta
 
 # ── Utilities ───────────────────────────────────────────────────
 def clean_float(x, default=0.0) -> float:
@@ -80,67 +81,298 @@ def clean_int(x, default=0) -> int:
     except Exception:
         return int(default)
 
+def clean_int_column(col: pd.Series, default=0) -> pd.Series:
+    """
+    clean_int for a whole column; non-numeric, NaN or inf values become default.
+    """
+    num = pd.to_numeric(col, errors="coerce").replace([np.inf, -np.inf], np.nan)
+    return num.round().fillna(default).astype(np.int64)
+
 # latin-1-safe text
 _REPL = {
     "\u2014": "-", "\u2013": "-", "\u2012": "-", "\u2010": "-", "\u2212": "-",
     "\u2018": "'", "\u2019": "'", "\u201c": '"', "\u201d": '"', "\u2022": "-",
     "\u00A0": " ",
 }
+_REPL_TRANS = str.maketrans(_REPL)
 def safe_text(val) -> str:
-    s = "" if val is None else str(val)
-    for a,b in _REPL.items(): s = s.replace(a,b)
+    # One translate pass for the known look-alikes, then anything else outside latin-1 becomes "?"
+    s = ("" if val is None else str(val)).translate(_REPL_TRANS)
+    return s.encode("latin-1", "replace").decode("latin-1")
+
+_FILENAME_TRANS = str.maketrans({" ": "_", "/": "-"})  # one translate pass for download / ZIP entry names
+
+COUNTING_SORT_MAX_MM = 100_000  # cut lengths are bounded by stock length; beyond this fall back to np.sort
+
+def sorted_desc(cuts_mm: List[int]) -> np.ndarray:
+    """
+    Positive cut lengths as int64, longest first.
+    """
+    arr = np.asarray(cuts_mm, dtype=np.float64)
+    arr = arr[arr > 0].astype(np.int64)
+    if arr.size == 0 or arr.max() > COUNTING_SORT_MAX_MM: return np.sort(arr)[::-1]
+    counts = np.bincount(arr)
+    lengths = np.flatnonzero(counts)[::-1]
+    return np.repeat(lengths, counts[lengths])
+
+# Warm, the numba loops beat the numpy ones from a few dozen pieces up (0.5 vs 2 ms at 500 pieces,
+# 5 vs 26 ms at 5k); below this both finish in ~2 ms, so small lists skip numba's one-off import + compile
+NUMBA_MIN_PIECES = 500
+
+def _ffd_assign(pieces, stock_len_mm, kerf_mm):
+    """
+    First-Fit of pieces onto new bars of stock_len_mm. Returns bar_of (bar index per piece),
+    remaining (free length per bar) and the bar count.
+    """
+    n = pieces.size
+    remaining = np.empty(n, dtype=np.float64)
+    bar_of = np.empty(n, dtype=np.int32)
+    nbars = 0
+    for i in range(n):
+        need = pieces[i] + kerf_mm
+        j = 0
+        while j < nbars and remaining[j] + 1e-6 < need: j += 1
+        if j < nbars: remaining[j] -= need
+        else: remaining[j] = stock_len_mm - pieces[i]; nbars += 1
+        bar_of[i] = j
+    return bar_of, remaining, nbars
+
+def _ffd_pack(pieces, remaining, kerf_mm):
+    """
+    First-Fit of pieces onto a fixed set of bars, updating remaining in place.
+    Returns the bar index per piece, -1 where it fits on none.
+    """
+    bar_of = np.full(pieces.size, -1, dtype=np.int32)
+    for i in range(pieces.size):
+        need = pieces[i] + kerf_mm
+        for j in range(remaining.size):
+            if remaining[j] + 1e-6 >= need:
+                remaining[j] -= need; bar_of[i] = j
+                break
+    return bar_of
+
+@st.cache_resource(show_spinner=False)
+def _jit_kernels() -> Optional[Dict[str, object]]:
+    """
+    The First-Fit loops above compiled with numba, once per server process; None without numba.
+    """
     try:
-        s.encode("latin-1"); return s
-    except UnicodeEncodeError:
-        return s.encode("latin-1", "replace").decode("latin-1")
+        from numba import njit
+    except Exception:  # not installed, or installed but broken (e.g. built against another numpy)
+        return None
+    return {"assign": njit(_ffd_assign), "pack": njit(_ffd_pack)}
 
-def explode_cuts(length_mm: int, qty: int) -> List[int]:
-    return [length_mm] * max(qty, 0)
+def group_by_bar(pieces: np.ndarray, bar_of: np.ndarray, nbars: int) -> List[List[int]]:
+    """
+    Per-bar cut lists from a bar index per piece (-1 = unplaced), in placement order.
+    """
+    if nbars == 0: return []
+    placed = bar_of >= 0
+    order = np.argsort(bar_of[placed], kind="stable")
+    pieces_per_bar = np.bincount(bar_of[placed], minlength=nbars)
+    return [c.tolist() for c in np.split(pieces[placed][order], np.cumsum(pieces_per_bar)[:-1])]
+
+def first_fit(pieces: np.ndarray, stock_len_mm: int, kerf_mm: float) -> List[Dict]:
+    """
+    First-Fit of int64 pieces, longest first: each goes on the first bar it fits, otherwise on a new bar.
+    """
+    if pieces.size == 0: return []
+    kernels = _jit_kernels() if pieces.size >= NUMBA_MIN_PIECES else None
+    if kernels is not None:
+        bar_of, remaining, nbars = kernels["assign"](pieces, float(stock_len_mm), float(kerf_mm))
+    else:
+        remaining = np.empty(pieces.size, dtype=np.float64)
+        bar_of = np.empty(pieces.size, dtype=np.int32)
+        nbars = 0; max_rem = -math.inf
+        for i, piece in enumerate(pieces.tolist()):
+            need = piece + kerf_mm  # an open bar already holds a cut, so kerf always applies
+            if max_rem + 1e-6 >= need:
+                j = int(np.flatnonzero(remaining[:nbars] + 1e-6 >= need)[0])
+                was_max = remaining[j] == max_rem
+                remaining[j] -= need
+                if was_max: max_rem = remaining[:nbars].max()
+            else:
+                j = nbars; remaining[j] = stock_len_mm - piece; nbars += 1
+                max_rem = max(max_rem, remaining[j])
+            bar_of[i] = j
+    return [{"cuts": c, "used": float(stock_len_mm - r), "waste": max(float(r), 0.0)}
+            for c, r in zip(group_by_bar(pieces, bar_of, nbars), remaining[:nbars].tolist())]
 
 def first_fit_decreasing(cuts_mm: List[int], stock_len_mm: int, kerf_mm: float) -> List[Dict]:
-    pieces = sorted([int(c) for c in cuts_mm if c > 0], reverse=True)
+    """
+    First-Fit Decreasing: each piece goes on the first bar it fits, otherwise on a new bar.
+    """
+    return first_fit(sorted_desc(cuts_mm), stock_len_mm, kerf_mm)
+
+def best_fit(pieces: np.ndarray, stock_len_mm: int, kerf_mm: float) -> List[Dict]:
+    """
+    Best-Fit of int64 pieces, longest first: each goes on the open bar with the least remaining length
+    that still fits it (lowest bar index on ties), otherwise on a new bar.
+    """
+    pieces = pieces.tolist()
     bars: List[Dict] = []
+    if not pieces: return bars
+    min_need = pieces[-1] + kerf_mm
+    open_bars: List[Tuple[float, int]] = []
     for piece in pieces:
-        placed = False
-        for bar in bars:
-            need = piece + (kerf_mm if len(bar["cuts"])>0 else 0.0)
-            if bar["used"] + need <= stock_len_mm + 1e-6:
-                bar["cuts"].append(piece); bar["used"] += need; placed = True; break
-        if not placed:
+        need = piece + kerf_mm  # every open bar already holds a cut, so kerf always applies
+        k = bisect.bisect_left(open_bars, (need - 1e-6, -1))
+        if k < len(open_bars):
+            rem, i = open_bars.pop(k)
+            bars[i]["cuts"].append(piece); bars[i]["used"] += need; rem -= need
+        else:
             bars.append({"cuts":[piece], "used":float(piece), "waste":0.0})
+            rem, i = stock_len_mm - piece, len(bars) - 1
+        if rem + 1e-6 >= min_need: bisect.insort(open_bars, (rem, i))
     for bar in bars:
         bar["waste"] = max(stock_len_mm - bar["used"], 0.0)
     return bars
 
-def bars_to_text_lines(bars: List[Dict], stock_len_mm: int) -> List[str]:
+def best_fit_decreasing(cuts_mm: List[int], stock_len_mm: int, kerf_mm: float) -> List[Dict]:
+    """
+    Best-Fit Decreasing: best_fit on the positive cuts, longest first.
+    """
+    return best_fit(sorted_desc(cuts_mm), stock_len_mm, kerf_mm)
+
+def fill_stock_bars(pieces: np.ndarray, lens: np.ndarray, kerf_mm: float,
+                    strategy: str = "bfd") -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Places pieces onto stock bars of lengths lens. Returns bar_of (bar index per piece, -1 if it
+    fits on none) and rem (each bar's free length plus one kerf).
+    """
+    rem = lens.astype(np.float64) + kerf_mm
+    bar_of = np.full(pieces.size, -1, dtype=np.int32)
+    if pieces.size == 0: return bar_of, rem
+    if strategy == "bfd":
+        # Same sorted (remaining, bar index) list as best_fit, seeded with the stock bars
+        min_need = pieces[-1] + kerf_mm
+        open_bars = sorted((r, j) for j, r in enumerate(rem.tolist()) if r + 1e-6 >= min_need)
+        for i, piece in enumerate(pieces.tolist()):
+            need = piece + kerf_mm
+            k = bisect.bisect_left(open_bars, (need - 1e-6, -1))
+            if k == len(open_bars): continue  # fits nowhere
+            r, j = open_bars.pop(k)
+            r -= need; rem[j] = r; bar_of[i] = j
+            if r + 1e-6 >= min_need: bisect.insort(open_bars, (r, j))
+        return bar_of, rem
+    kernels = _jit_kernels() if pieces.size >= NUMBA_MIN_PIECES else None
+    if kernels is not None:
+        return kernels["pack"](pieces, rem, float(kerf_mm)), rem
+    max_rem = rem.max() if rem.size else -math.inf
+    for i, piece in enumerate(pieces.tolist()):
+        need = piece + kerf_mm
+        if max_rem + 1e-6 < need: continue  # fits nowhere: skip the scan
+        j = int(np.flatnonzero(rem + 1e-6 >= need)[0])
+        was_max = rem[j] == max_rem
+        rem[j] -= need; bar_of[i] = j
+        if was_max: max_rem = rem.max()
+    return bar_of, rem
+
+NESTING_STRATEGIES = {"bfd": best_fit, "ffd": first_fit}  # both take pieces already longest first
+
+CutCounts = Tuple[Tuple[int, int], ...]  # ((length_mm, qty), ...) longest first
+
+def count_cuts(pieces: List[int]) -> CutCounts:
+    """
+    Compresses a piece list into (length, qty) pairs, longest first.
+    """
+    lengths, qtys = np.unique(np.asarray(pieces, dtype=np.int64), return_counts=True)
+    return tuple(zip(lengths[::-1].tolist(), qtys[::-1].tolist()))
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def nest_lengths(cut_counts: CutCounts, stock_len_mm: int, kerf_mm: float,
+                 strategy: str = "bfd") -> Tuple[Tuple[Tuple[int, ...], float, float], ...]:
+    """
+    Nests (length, qty) cut counts onto bars of stock_len_mm. Returns (cuts, used, waste) per bar.
+    """
+    if len(cut_counts) == 1:
+        # A single cut length packs the same way under either strategy: full bars of per_bar cuts, then the rest
+        length, qty = cut_counts[0]
+        per_bar = 1 + max(int((stock_len_mm - length + 1e-6) // (length + kerf_mm)), 0)
+        def bar(n: int) -> Tuple[Tuple[int, ...], float, float]:
+            used = float(n * length + (n - 1) * kerf_mm)
+            return (length,) * n, used, max(stock_len_mm - used, 0.0)
+        return (bar(per_bar),) * (qty // per_bar) + ((bar(qty % per_bar),) if qty % per_bar else ())
+    nest = NESTING_STRATEGIES[strategy]
+    pieces = np.repeat([length for length, _ in cut_counts], [qty for _, qty in cut_counts]).astype(np.int64)  # longest first
+    return tuple((tuple(b["cuts"]), b["used"], b["waste"]) for b in nest(pieces, stock_len_mm, kerf_mm))
+
+def nest_to_bars(cut_counts: CutCounts, stock_len_mm: int, kerf_mm: float, strategy: str = "bfd") -> List[Dict]:
+    key = tuple(sorted(((int(length), int(qty)) for length, qty in cut_counts if length > 0), reverse=True))
+    return [{"cuts": list(c), "used": u, "waste": w} for c, u, w in nest_lengths(key, int(stock_len_mm), float(kerf_mm), strategy)]
+
+Inventory = Tuple[Tuple[int, int], ...]  # ((stock_length_mm, bars_available), ...) in table order
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def nest_on_stock(cut_counts: CutCounts, inventory: Inventory, kerf_mm: float,
+                  strategy: str = "bfd") -> Tuple[int, Tuple[Tuple[Tuple[int, ...], float, float], ...]]:
+    """
+    Nests one section onto the listed stock bars, then extra bars of the first listed length (6000 mm
+    if none). Returns the dominant stock length and (cuts, used, waste) per bar, waste against that length.
+    """
+    cut_counts = sorted(cut_counts, reverse=True)  # fill_stock_bars expects pieces longest first
+    pieces = np.repeat([length for length, _ in cut_counts], [qty for _, qty in cut_counts]).astype(np.int64)
+    base_len = inventory[0][0] if inventory else 6000
+    lens = np.repeat([length for length, _ in inventory], [qty for _, qty in inventory]).astype(np.int64)
+    bar_of, rem = fill_stock_bars(pieces, lens, kerf_mm, strategy)
+    bar_cuts = group_by_bar(pieces, bar_of, lens.size)
+    n_cuts = np.bincount(bar_of[bar_of >= 0], minlength=lens.size)
+    used = np.where(n_cuts > 0, lens - rem, 0.0)
+
+    remaining = pieces[bar_of < 0]
+    if remaining.size:
+        extra = nest_to_bars(count_cuts(remaining), base_len, kerf_mm, strategy)
+        bar_cuts += [b["cuts"] for b in extra]
+        lens = np.concatenate([lens, np.full(len(extra), base_len, dtype=np.int64)])
+        used = np.concatenate([used, [b["used"] for b in extra]])
+
+    dominant_len = base_len
+    if lens.size > 0:
+        vals, counts = np.unique(lens, return_counts=True); dominant_len = int(vals[counts.argmax()])
+    waste = np.maximum(dominant_len - used, 0.0)  # scrap against the dominant length, as the PDF draws every bar
+    return dominant_len, tuple(zip(map(tuple, bar_cuts), used.tolist(), waste.tolist()))
+
+def bars_to_text(bars: List[Dict], stock_len_mm: int) -> str:
+    """
+    The section's cutting list as text, one line per bar.
+    """
     lines = [f"Stock {stock_len_mm} mm - Bars used: {len(bars)}"]
-    for i, b in enumerate(bars, 1):
-        cuts_str = "|".join(str(int(c)) for c in b["cuts"])
-        scrap = max(stock_len_mm - b["used"], 0.0)
-        lines.append(f"Bar {i}: |{cuts_str}| scrap: {int(round(scrap))} mm")
-    return [safe_text(x) for x in lines]
+    lines += [f"Bar {i}: |{'|'.join(map(str, b['cuts']))}| scrap: {int(round(b['waste']))} mm"
+              for i, b in enumerate(bars, 1)]
+    return "\n".join(lines)
+
+def logo_to_png(data: bytes) -> str:
+    """
+    Writes logo bytes to a temp image file. If Pillow is available, convert to PNG (better FPDF compatibility).
+    """
+    import tempfile
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
+    try:
+        from PIL import Image  # optional: Pillow improves logo reliability (JPG/PNG → PNG)
+        with Image.open(io.BytesIO(data)) as im:
+            if im.mode not in ("RGB", "L"): im = im.convert("RGB")
+            im.save(tmp.name, format="PNG"); return tmp.name
+    except Exception:
+        pass
+    with open(tmp.name, "wb") as f: f.write(data)
+    return tmp.name
 
 def normalize_logo(uploaded_file) -> str:
     """
-    Returns a local image path. If Pillow is available, convert to PNG (better FPDF compatibility).
-    Priority: uploaded file -> local 'pg_bison_logo.png' -> ''.
+    Returns a local image path. Priority: uploaded file -> local 'pg_bison_logo.png' -> ''.
     """
     data = None
     if uploaded_file is not None:
-        data = uploaded_file.read()
+        data = uploaded_file.getvalue()
     elif os.path.exists("pg_bison_logo.png"):
         with open("pg_bison_logo.png","rb") as f: data = f.read()
     if not data: return ""
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-    if _PIL_OK:
-        try:
-            with Image.open(io.BytesIO(data)) as im:
-                if im.mode not in ("RGB", "L"): im = im.convert("RGB")
-                im.save(tmp.name, format="PNG"); return tmp.name
-        except Exception:
-            pass
-    with open(tmp.name, "wb") as f: f.write(data)
-    return tmp.name
+    key = hashlib.md5(data).hexdigest()
+    cached = st.session_state.get("logo_png")
+    if cached and cached[0] == key and os.path.exists(cached[1]): return cached[1]
+    path = logo_to_png(data)
+    st.session_state["logo_png"] = (key, path)
+    return path
 
 # ── Inputs (Section-based) ──────────────────────────────────────
 st.header("✏️ Required Cuts (grouped by Section Size)")
@@ -186,32 +418,52 @@ else:
     stock_df = pd.DataFrame(columns=["Section Size", "Stock Length (mm)", "Bars Available"])
 
 # ── Grouping ────────────────────────────────────────────────────
-def group_by_section(df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+def group_by_section(df: pd.DataFrame) -> Dict[str, Tuple[pd.DataFrame, CutCounts]]:
+    """
+    Cleans the Required Cuts table and maps each Section Size to (its rows, its (length, qty) cut counts).
+    """
     cols = ["Section Size", "Cut Length (mm)", "Quantity", "Stock Length (mm)", "Tag (optional)", "Note"]
     for c in cols:
         if c not in df.columns: df[c] = np.nan
     df["Section Size"] = df["Section Size"].fillna("").astype(str)
-    df["Cut Length (mm)"] = df["Cut Length (mm)"].apply(clean_int)
-    df["Quantity"] = df["Quantity"].apply(clean_int)
-    df["Stock Length (mm)"] = df["Stock Length (mm)"].apply(lambda v: clean_int(v, 0))
+    blank = (df["Section Size"] == "") & df[["Cut Length (mm)", "Quantity"]].isna().all(axis=1)
+    for c in ["Cut Length (mm)", "Quantity", "Stock Length (mm)"]:
+        df[c] = clean_int_column(df[c])
     df["Tag (optional)"] = df["Tag (optional)"].fillna("").astype(str)
     df["Note"] = df["Note"].fillna("").astype(str)
-    df = df[(df["Section Size"] != "") & (df["Cut Length (mm)"] > 0) & (df["Quantity"] > 0)].copy()
-    groups = {}
-    for sec, g in df.groupby("Section Size", dropna=False):
-        groups[sec] = g.reset_index(drop=True)
-    return groups
+    valid = (df["Section Size"] != "") & (df["Cut Length (mm)"] > 0) & (df["Quantity"] > 0)
+    bad_rows = np.flatnonzero((~valid & ~blank).to_numpy()) + 1
+    if bad_rows.size:
+        st.warning(f"Skipped row(s) {', '.join(map(str, bad_rows.tolist()))}: each row needs a Section Size "
+                   "and a positive numeric Cut Length and Quantity.")
+    df = df[valid].copy()
+    qty_by_len = df.groupby(["Section Size", "Cut Length (mm)"])["Quantity"].sum()
+    counts = {sec: tuple(zip(q.index.get_level_values(1)[::-1].tolist(), q.to_numpy()[::-1].tolist()))
+              for sec, q in qty_by_len.groupby(level=0)}
+    return {sec: (g.reset_index(drop=True), counts[sec]) for sec, g in df.groupby("Section Size", dropna=False)}
 
 # ── PDF helpers (Word layout, no charts) ────────────────────────
-def draw_header(pdf: FPDF, logo_path: str):
-    if logo_path and os.path.exists(logo_path):
+def draw_header(pdf: "FPDF", logo_path: str) -> str:
+    """
+    Places the logo; returns '' if it could not be placed, so later pages do not retry it.
+    """
+    if logo_path:
         try:
             pdf.image(logo_path, x=10, y=10, w=38)
         except Exception:
-            pass
+            logo_path = ""
     pdf.set_y(10)
+    return logo_path
+
+META_ROWS = ["Project","Location","Drawing Number","Revision","Material","Cutting List By","Date Created"]
+
+def meta_table_rows(meta: Dict) -> List[Tuple[str, str]]:
+    """
+    (label, value) pairs for the metadata table, made latin-1 safe.
+    """
+    return [(label, safe_text(meta.get(label,""))) for label in META_ROWS]
 
-def draw_meta_table(pdf: FPDF, meta: Dict):
+def draw_meta_table(pdf: "FPDF", rows: List[Tuple[str, str]]):
     """
     Full-width table matching the content width (same as pdf.cell(0, ...)).
     Left column is fixed label width; right column stretches to fill the rest.
@@ -221,156 +473,211 @@ def draw_meta_table(pdf: FPDF, meta: Dict):
     label_w = 55                                   # keep your label width
     value_w = page_w - label_w                     # stretch the value column to full width
     row_h = 8
-    rows = ["Project","Location","Drawing Number","Revision","Material","Cutting List By","Date Created"]
-    for label in rows:
+    for label, value in rows:
         pdf.set_x(pdf.l_margin)
-        pdf.set_font("Helvetica", "", 11); pdf.cell(label_w, row_h, safe_text(label), border=1)
-        pdf.set_font("Helvetica", "B", 11); pdf.cell(value_w, row_h, safe_text(meta.get(label,"")), border=1, ln=1)
+        pdf.set_font("Helvetica", "", 11); pdf.cell(label_w, row_h, label, border=1)
+        pdf.set_font("Helvetica", "B", 11); pdf.cell(value_w, row_h, value, border=1, ln=1)
     pdf.ln(2)
 
-def write_section_block(pdf: FPDF, section: str, stock_len_mm: int, bars: List[Dict]):
+def write_section_block(pdf: "FPDF", section: str, stock_len_mm: int, bars: List[Dict]):
     pdf.set_font("Helvetica", "B", 12)
-    pdf.cell(0, 8, safe_text(f"Section Size   {section}"), border=1, ln=1)  # 0 → spans full content width
+    pdf.cell(0, 8, f"Section Size   {section}", border=1, ln=1)  # 0 → spans full content width; section is already safe_text'd
     pdf.ln(1)
     pdf.set_font("Helvetica", "", 11)
-    for line in bars_to_text_lines(bars, stock_len_mm):
-        pdf.cell(0, 6, safe_text(line), ln=1)
+    pdf.multi_cell(0, 6, bars_to_text(bars, stock_len_mm), align="L")  # one call; long bar lines wrap
     pdf.ln(2)
 
-def consolidated_pdf(meta: Dict, logo_path: str, payloads: List[Tuple[str,int,float,pd.DataFrame,List[Dict]]]) -> bytes:
+def render_pdf(meta: Dict, logo_path: str, payloads: List[Tuple[str,int,float,pd.DataFrame,List[Dict]]],
+               include_note: bool = True) -> bytes:
+    """
+    One FPDF document for all payloads, a page per section.
+    """
+    from fpdf import FPDF
     pdf = FPDF(orientation="P", unit="mm", format="A4")
     pdf.set_auto_page_break(auto=True, margin=10)
+    meta_rows = meta_table_rows(meta)
+    note = safe_text(meta.get("Document Note", "")) if include_note else ""
+    logo_path = logo_path if logo_path and os.path.exists(logo_path) else ""  # checked once, not per page
     for idx, (section, stock_len_mm, _k, df_section, bars) in enumerate(payloads):
-        pdf.add_page(); draw_header(pdf, logo_path); draw_meta_table(pdf, meta)
-        if idx == 0 and meta.get("Document Note"):
-            pdf.set_font("Helvetica", "", 10); pdf.multi_cell(0, 5, safe_text(meta["Document Note"])); pdf.ln(1)
+        pdf.add_page(); logo_path = draw_header(pdf, logo_path); draw_meta_table(pdf, meta_rows)
+        if idx == 0 and note:
+            pdf.set_font("Helvetica", "", 10); pdf.multi_cell(0, 5, note); pdf.ln(1)
         write_section_block(pdf, section, stock_len_mm, bars)
     return pdf.output(dest="S").encode("latin-1")
 
+def payload_digest(payloads: List[Tuple[str,int,float,pd.DataFrame,List[Dict]]]) -> str:
+    """
+    Hash of the parts of the payloads that the PDFs render.
+    """
+    return hashlib.md5(repr([(s, slen, k, bars) for s, slen, k, _g, bars in payloads]).encode()).hexdigest()
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def consolidated_pdf(meta: Dict, logo_path: str, payload_key: str, _payloads: List[Tuple[str,int,float,pd.DataFrame,List[Dict]]]) -> bytes:
+    """
+    The consolidated PDF for all sections.
+    """
+    return render_pdf(meta, logo_path, _payloads)
+
 def single_section_pdf(meta: Dict, logo_path: str, section: str, stock_len_mm: int, _k: float,
                        df_section: pd.DataFrame, bars: List[Dict]) -> bytes:
-    pdf = FPDF(orientation="P", unit="mm", format="A4")
-    pdf.set_auto_page_break(auto=True, margin=10)
-    pdf.add_page(); draw_header(pdf, logo_path); draw_meta_table(pdf, meta)
-    write_section_block(pdf, section, stock_len_mm, bars)
-    return pdf.output(dest="S").encode("latin-1")
+    return render_pdf(meta, logo_path, [(section, stock_len_mm, _k, df_section, bars)], include_note=False)
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def per_section_zip(meta: Dict, logo_path: str, payload_key: str, _payloads: List[Tuple[str,int,float,pd.DataFrame,List[Dict]]]) -> bytes:
+    """
+    One PDF per section, in an in-memory ZIP.
+    """
+    import zipfile
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for section, slen, k, g, bars in _payloads:
+            zf.writestr(f"{section.translate(_FILENAME_TRANS)}.pdf",
+                        single_section_pdf(meta, logo_path, section, slen, k, g, bars))
+    return buf.getvalue()
 
 # ── Payload builders ────────────────────────────────────────────
-def payloads_by_required(req_df: pd.DataFrame, default_stock_len_mm: int, kerf_mm: float):
+def payloads_by_required(req_df: pd.DataFrame, default_stock_len_mm: int, kerf_mm: float, strategy: str = "bfd"):
     payloads = []
-    for section, g in group_by_section(req_df).items():
+    for section, (g, cut_counts) in group_by_section(req_df).items():
         s_vals = [clean_int(v, 0) for v in g.get("Stock Length (mm)", [])]
         s_override = next((v for v in s_vals if v and v > 0), 0) if len(s_vals)>0 else 0
         stock_len = s_override if s_override > 0 else default_stock_len_mm
-        pieces = []; 
-        for _, r in g.iterrows():
-            pieces.extend(explode_cuts(clean_int(r["Cut Length (mm)"]), clean_int(r["Quantity"])))
-        bars = first_fit_decreasing(pieces, stock_len, kerf_mm)
+        bars = nest_to_bars(cut_counts, stock_len, kerf_mm, strategy)
         payloads.append((safe_text(section), stock_len, kerf_mm, g, bars))
     return payloads
 
-def payloads_from_stock(req_df: pd.DataFrame, stock_df: pd.DataFrame, kerf_mm: float):
+def payloads_from_stock(req_df: pd.DataFrame, stock_df: pd.DataFrame, kerf_mm: float, strategy: str = "bfd"):
     payloads = []; req_groups = group_by_section(req_df)
     stock_df = stock_df.copy()
     for c in ["Section Size", "Stock Length (mm)", "Bars Available"]:
         if c not in stock_df.columns: stock_df[c] = 0
     stock_df["Section Size"] = stock_df["Section Size"].fillna("").astype(str)
-    stock_df["Stock Length (mm)"] = stock_df["Stock Length (mm)"].apply(clean_int)
-    stock_df["Bars Available"] = stock_df["Bars Available"].apply(clean_int)
-
-    stock_by_sec: Dict[str, List[Tuple[int, int]]] = {}
-    for _, r in stock_df.iterrows():
-        if r["Section Size"] == "" or r["Stock Length (mm)"] <= 0 or r["Bars Available"] <= 0: continue
-        stock_by_sec.setdefault(r["Section Size"], []).append((int(r["Stock Length (mm)"]), int(r["Bars Available"])))
-
-    for section, g in req_groups.items():
-        pieces = []; 
-        for _, r in g.iterrows():
-            pieces.extend(explode_cuts(clean_int(r["Cut Length (mm)"]), clean_int(r["Quantity"])))
-        pieces = sorted([p for p in pieces if p > 0], reverse=True)
-
-        inv = stock_by_sec.get(section, [])
-        bars: List[Dict] = []
-        for length_mm, qty in inv:
-            for _ in range(int(qty)): bars.append({"len": length_mm, "cuts": [], "used": 0.0})
-
-        remaining = pieces.copy()
-        for piece in remaining[:]:
-            placed = False
-            for bar in bars:
-                need = piece + (kerf_mm if len(bar["cuts"]) > 0 else 0.0)
-                if bar["used"] + need <= bar["len"] + 1e-6:
-                    bar["cuts"].append(piece); bar["used"] += need; placed = True; break
-            if placed: remaining.remove(piece)
-
-        if len(remaining) > 0:
-            base_len = inv[0][0] if len(inv) > 0 else 6000
-            extra = first_fit_decreasing(remaining, base_len, kerf_mm)
-            for b in extra: bars.append({"len": base_len, "cuts": b["cuts"][:], "used": b["used"]})
-
-        dominant_len = (inv[0][0] if len(inv)>0 else 6000)
-        if len(bars) > 0:
-            lengths = [b["len"] for b in bars]; dominant_len = int(pd.Series(lengths).mode().iloc[0])
-
-        normalized = []
-        for b in bars:
-            normalized.append({"cuts": b["cuts"], "used": b["used"], "waste": max(dominant_len - b["used"], 0.0)})
+    stock_df["Stock Length (mm)"] = clean_int_column(stock_df["Stock Length (mm)"])
+    stock_df["Bars Available"] = clean_int_column(stock_df["Bars Available"])
+
+    ok = (stock_df["Section Size"] != "") & (stock_df["Stock Length (mm)"] > 0) & (stock_df["Bars Available"] > 0)
+    stock_by_sec: Dict[str, Inventory] = {
+        sec: tuple(zip(s["Stock Length (mm)"].tolist(), s["Bars Available"].tolist()))
+        for sec, s in stock_df[ok].groupby("Section Size", sort=False)
+    }
+    for section, (g, cut_counts) in req_groups.items():
+        dominant_len, bars = nest_on_stock(cut_counts, stock_by_sec.get(section, ()), float(kerf_mm), strategy)
+        normalized = [{"cuts": list(c), "used": u, "waste": w} for c, u, w in bars]
         payloads.append((safe_text(section), dominant_len, kerf_mm, g, normalized))
     return payloads
 
 # ── Run ─────────────────────────────────────────────────────────
+NESTING_MODES = ("Nest by Required Cuts", "Nest from Stock")
+
 st.write("---")
 col_run, col_sp = st.columns([1, 3])
 with col_run:
-    run = st.button("⚙️ Run Nesting & Build PDF", type="primary")
+    run = st.button("⚙️ Run Nesting", type="primary")
+
+def input_fingerprint() -> str:
+    """
+    Hash of every input a nesting run reads: mode, settings and both tables.
+    """
+    h = hashlib.md5(repr((mode, kerf_mm, strategy, default_stock_length_mm)).encode())
+    for df in (req_df, stock_df):
+        h.update(repr(list(df.columns)).encode())
+        h.update(pd.util.hash_pandas_object(df.astype(str), index=True).to_numpy().tobytes())
+    return h.hexdigest()
+
+fingerprint = input_fingerprint() if mode in NESTING_MODES else None  # the tables only exist in these modes
 
-if run:
-    error_box = st.empty()
+if run and mode in NESTING_MODES:
+    # Nesting only: the result is kept in session_state and PDFs are built on request below
+    st.session_state.pop("export", None)
     try:
         if mode == "Nest by Required Cuts":
-            payloads = payloads_by_required(req_df, default_stock_length_mm, kerf_mm)
-        elif mode == "Nest from Stock":
-            payloads = payloads_from_stock(req_df, stock_df, kerf_mm)
+            payloads = payloads_by_required(req_df, default_stock_length_mm, kerf_mm, strategy)
         else:
-            payloads = []
-
-        if mode in ("Nest by Required Cuts", "Nest from Stock") and len(payloads) == 0:
+            payloads = payloads_from_stock(req_df, stock_df, kerf_mm, strategy)
+        st.session_state["nesting"] = (fingerprint, payloads)
+        if len(payloads) == 0:
             st.warning("No valid rows found. Please add Section Size, Cut Length, and Quantity.")
-        else:
-            logo_path = normalize_logo(logo_file)
-
-            all_pdf = consolidated_pdf(project_meta, logo_path, payloads)
-            st.download_button(
-                "⬇️ Download Consolidated PDF",
-                data=all_pdf,
-                file_name=f"nesting_{safe_text(project_meta['Project']).replace(' ','_')}.pdf",
-                mime="application/pdf",
-                use_container_width=True,
-            )
+    except Exception as e:
+        st.session_state.pop("nesting", None)
+        st.error(f"Something went wrong: {e}")
 
-            if offer_zip:
-                files = {}
-                for section, slen, k, g, bars in payloads:
-                    b = single_section_pdf(project_meta, logo_path, section, slen, k, g, bars)
-                    files[f"{section.replace(' ','_').replace('/','-')}.pdf"] = b
-                import zipfile
-                buf = io.BytesIO()
-                with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
-                    for name, data in files.items(): zf.writestr(name, data)
-                st.download_button(
-                    "⬇️ Download Per-Section PDFs (ZIP)",
-                    data=buf.getvalue(),
-                    file_name=f"nesting_{safe_text(project_meta['Project']).replace(' ','_')}_per_section.zip",
-                    mime="application/zip",
-                    use_container_width=True,
-                )
-
-        if mode in ("Nest by Required Cuts", "Nest from Stock") and len(payloads) > 0:
-            st.success("PDF built with full-width metadata table and section banner.")
+def preview_frame(payloads: List[Tuple[str,int,float,pd.DataFrame,List[Dict]]]) -> pd.DataFrame:
+    """
+    One row per bar across all sections.
+    """
+    all_bars = [b for *_, bars in payloads for b in bars]
+    return pd.DataFrame({
+        "Section Size": np.repeat([p[0] for p in payloads], [len(p[4]) for p in payloads]),
+        "Stock Length (mm)": np.repeat([p[1] for p in payloads], [len(p[4]) for p in payloads]),
+        "Bar": np.concatenate([np.arange(1, len(p[4]) + 1) for p in payloads]) if payloads else [],
+        "Cuts": [len(b["cuts"]) for b in all_bars],
+        "Cut List (mm)": [" | ".join(map(str, b["cuts"])) for b in all_bars],
+        "Scrap (mm)": [int(round(b["waste"])) for b in all_bars],
+    })
 
-    except Exception as e:
-        error_box.error(f"Something went wrong: {e}")
+def show_preview(payloads: List[Tuple[str,int,float,pd.DataFrame,List[Dict]]]):
+    """
+    On-screen summary of the last run: one row per section, with the per-bar cutting list below.
+    """
+    st.subheader("📊 Nesting Preview")
+    bars_df = preview_frame(payloads)
+    summary = bars_df.groupby(["Section Size", "Stock Length (mm)"], sort=False).agg(
+        **{"Bars Used": ("Bar", "size"), "Cuts": ("Cuts", "sum"), "Total Scrap (mm)": ("Scrap (mm)", "sum")}
+    ).reset_index()
+    st.dataframe(summary, use_container_width=True, hide_index=True)
+    with st.expander("Per-bar cutting list"):
+        st.dataframe(bars_df.drop(columns="Stock Length (mm)"), use_container_width=True, hide_index=True)
+
+@st.fragment
+def export_panel(payloads: List[Tuple[str,int,float,pd.DataFrame,List[Dict]]]):
+    """
+    PDF export for the last run. Built files are kept until the run, project details,
+    logo or ZIP choice change.
+    """
+    meta = read_project_meta()
+    export_key = (meta, offer_zip, getattr(logo_file, "file_id", None))
+    if st.session_state.get("export", (None,))[0] != export_key:
+        st.session_state.pop("export", None)  # built from other details, logo or ZIP choice
+    if st.button("📄 Build PDF"):
+        try:
+            logo_path = normalize_logo(logo_file)
+            payload_key = payload_digest(payloads)
+            st.session_state["export"] = (
+                export_key,
+                f"nesting_{safe_text(meta['Project']).translate(_FILENAME_TRANS)}",
+                consolidated_pdf(meta, logo_path, payload_key, payloads),
+                per_section_zip(meta, logo_path, payload_key, payloads) if offer_zip else None,
+            )
+        except Exception as e:
+            st.session_state.pop("export", None)
+            st.error(f"Something went wrong: {e}")
+    if "export" not in st.session_state: return
+    _key, file_stem, all_pdf, zip_data = st.session_state["export"]
+    st.download_button(
+        "⬇️ Download Consolidated PDF",
+        data=all_pdf,
+        file_name=f"{file_stem}.pdf",
+        mime="application/pdf",
+        use_container_width=True,
+    )
+    if zip_data is not None:
+        st.download_button(
+            "⬇️ Download Per-Section PDFs (ZIP)",
+            data=zip_data,
+            file_name=f"{file_stem}_per_section.zip",
+            mime="application/zip",
+            use_container_width=True,
+        )
+    st.success("PDF built with full-width metadata table and section banner.")
+
+last_fingerprint, last_payloads = st.session_state.get("nesting", (None, []))
+if mode in NESTING_MODES and last_payloads:
+    if last_fingerprint == fingerprint:
+        show_preview(last_payloads)
+        export_panel(last_payloads)
+    else:
+        st.info("Inputs changed – re-run **Run Nesting** to update the preview and PDF.")
 
 if mode == "View Summary Report":
-    st.info("Switch to one of the nesting modes and click **Run Nesting & Build PDF** to generate outputs.")
-    st.write("Project summary:"); st.json(project_meta, expanded=False)
+    st.info("Switch to one of the nesting modes, click **Run Nesting**, then **Build PDF** to generate outputs.")
+    st.write("Project summary:"); st.json(read_project_meta(), expanded=False)